@@ -47,6 +47,15 @@ class VehiclePIDController():
         self._lon_controller = PIDLongitudinalController(self._vehicle, **args_longitudinal)
         self._lat_controller = PIDLateralController(self._vehicle, **args_lateral)
 
+    def reset(self):
+        """
+        Drop the PID error history and resync the steering rate limit
+        with the steering currently applied to the vehicle.
+        """
+        self.past_steering = self._vehicle.get_control().steer
+        self._lon_controller._error_buffer.clear()
+        self._lat_controller._e_buffer.clear()
+
     def run_step(self, target_speed, waypoint):
         """
         Execute one step of control invoking both lateral and longitudinal
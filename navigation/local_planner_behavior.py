@@ -10,18 +10,59 @@
 low-level waypoint following based on PID controllers. """
 
 from collections import deque
+from itertools import islice
+import concurrent.futures
 from enum import Enum
+import logging
 import numpy as np
 import math
 import cv2
-import matplotlib.pyplot as plt
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the path conversion runs as plain NumPy
+    def njit(**kwargs):
+        return lambda func: func
 
 import carla
 from agents.navigation.controller import VehiclePIDController
-from agents.tools.misc import distance_vehicle, draw_waypoints
+from agents.tools.misc import draw_waypoints
 from agents.navigation.rrt_grid import RRT
 
+log = logging.getLogger(__name__)
+
+# BEV images are downsampled by this factor before building the grid
+GRID_SCALE = 0.5
+# ego vehicle pixel and resolution of the downsampled grid, derived from
+# the full resolution BEV values (75, 168) and 4 pixels per metre
+START_X = int(75 * GRID_SCALE)
+START_Y = int(168 * GRID_SCALE)
+PIXELS_PER_METRE = 4 * GRID_SCALE
+
+
+@njit(cache=True)
+def path_pixels_to_world(xs, ys, cw_x, cw_y, cw_yaw_rad):
+    """
+    Vectorized version of LocalPlanner.pixel_to_world for a whole RRT path.
+
+        :param xs: array of pixel columns of the path points
+        :param ys: array of pixel rows of the path points
+        :param cw_x: x of the current vehicle waypoint in world coordinates
+        :param cw_y: y of the current vehicle waypoint in world coordinates
+        :param cw_yaw_rad: yaw of the current vehicle waypoint in radians
+        :return: arrays of world x and y of the path points
+    """
+    ax = (xs - START_X).astype(np.float64)
+    by = (ys - START_Y).astype(np.float64)
+    d = np.sqrt(ax * ax + by * by)
+    # ax is 0 wherever d is, so guarding d keeps alpha 0 at the start pixel
+    alpha = np.arcsin(np.abs(ax) / np.maximum(d, 1e-9))
 
+    gamma = cw_yaw_rad + alpha  # vehicle angle + alpha
+    d = d / PIXELS_PER_METRE
+
+    return cw_x + d * np.sin(gamma), cw_y + d * np.cos(gamma)
 
 
 class RoadOption(Enum):
@@ -56,6 +97,16 @@ class LocalPlanner(object):
     # FPS used for dt
     FPS = 20
 
+    # spacing, in global plan waypoints, of the buffered waypoints
+    WAYPOINT_STRIDE = 5
+
+    # pixel value of the spawned vehicle in the BEV image
+    VEHICLE_COLOR = 164
+
+    # occupancy grid values, blocked cells are 0
+    GRID_FREE = 255
+    GRID_VEHICLE = 128
+
     def __init__(self, agent):
         """
         :param agent: agent that regulates the vehicle
@@ -74,9 +125,13 @@ class LocalPlanner(object):
         self._vehicle_controller = None
         self._global_plan = None
         self._pid_controller = None
+        self._pid_hw = None
+        self._pid_city = None
         self.waypoints_queue = deque(maxlen=20000)  # queue with tuples of (waypoint, RoadOption)
         self._buffer_size = 5
         self._waypoint_buffer = deque(maxlen=self._buffer_size)
+        # x, y of the buffered waypoints, kept in step with _waypoint_buffer
+        self._buf_xy = np.empty((self._buffer_size, 2), dtype=np.float32)
         self.rrt_buffer = deque(maxlen=10000)
 
         self.cw_x   =     None
@@ -88,7 +143,28 @@ class LocalPlanner(object):
         self._b     =     None
         self._a     =     None
         self.path   =     None
-
+        self._cw_yaw_rad = None
+
+        # last RRT plan, reused while the grid and goal stay the same
+        self._last_grid_key = None
+        self._last_goal = None
+        self._last_path = None
+
+        # RRT runs on a worker thread while the previous path is followed.
+        # On a free-threaded (3.13t) build planning runs truly in parallel,
+        # with the GIL it still overlaps the blocking CARLA calls.
+        self._planner_exec = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_plan = None
+        self._pending_args = None
+        # matplotlib animation of the RRT search, far too slow for the control loop
+        self._rrt_debug = False
+        self.local_target = None
+
+        # lookup table from BEV pixel value to grid value: 255 free, 0 blocked
+        self._occ_lut = np.full(256, self.GRID_FREE, dtype=np.uint8)
+        self._occ_lut[0] = 0
+        self._occ_lut[150] = 0
+        self._grid_buf = None
 
 
         self._init_controller()  # initializing controller
@@ -138,6 +214,14 @@ class LocalPlanner(object):
             'K_I': 0.07,
             'dt': 1.0 / self.FPS}
 
+        # one controller per profile, reused across steps
+        self._pid_hw = VehiclePIDController(self._vehicle,
+                                            args_lateral=self.args_lat_hw_dict,
+                                            args_longitudinal=self.args_long_hw_dict)
+        self._pid_city = VehiclePIDController(self._vehicle,
+                                              args_lateral=self.args_lat_city_dict,
+                                              args_longitudinal=self.args_long_city_dict)
+
         self._current_waypoint = self._map.get_waypoint(self._vehicle.get_location())
 
         self._global_plan = False
@@ -161,20 +245,36 @@ class LocalPlanner(object):
 
             :param current_plan: list of waypoints in the actual plan
         """
-        for elem in current_plan:
-            self.waypoints_queue.append(elem)
+        self.waypoints_queue.extend(current_plan)
 
         if clean:
             self._waypoint_buffer.clear()
-            for _ in range(self._buffer_size):
-                if self.waypoints_queue:
-                    self._waypoint_buffer.append(
-                        self.waypoints_queue.popleft())
-                else:
-                    break
+            for _ in range(min(self._buffer_size, len(self.waypoints_queue))):
+                self._buffer_append(self.waypoints_queue.popleft())
 
         self._global_plan = True
 
+    def _buffer_append(self, elem):
+        """
+        Appends a (waypoint, RoadOption) tuple to the waypoint buffer.
+
+            :param elem: tuple to buffer
+        """
+        location = elem[0].transform.location
+        self._buf_xy[len(self._waypoint_buffer)] = (location.x, location.y)
+        self._waypoint_buffer.append(elem)
+
+    def _buffer_popleft(self, count=1):
+        """
+        Removes the first waypoints of the waypoint buffer.
+
+            :param count: number of waypoints to remove
+        """
+        n = len(self._waypoint_buffer)
+        self._buf_xy[:n - count] = self._buf_xy[count:n]
+        for _ in range(count):
+            self._waypoint_buffer.popleft()
+
     def get_incoming_waypoint_and_direction(self, steps=3):
         """
         Returns direction and waypoint at a distance ahead defined by the user.
@@ -195,48 +295,69 @@ class LocalPlanner(object):
     
     def occupancy_grid(self,img): 
           
+        # nearest neighbour keeps the palette values intact
+        img = cv2.resize(img, None, fx=GRID_SCALE, fy=GRID_SCALE,
+                         interpolation=cv2.INTER_NEAREST)
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        img = np.asarray(img)
-        #print(np.unique(img, return_counts=True))
-        pixel_value, pixel_freq = np.unique(img, return_counts=True)
-        vehicle_pixels = [pixel_value[i] for i in range (len(pixel_value)) if pixel_freq[i]<500]
-        vehicle_color = 164 #pixel value of the spawned vehicle in the BEV image
-        #start_pos = np.where(img == vehicle_color)
+        # one histogram pass over the palette image instead of a full
+        # image scan per rare pixel value
+        pixel_freq = cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+        #start_pos = np.where(img == self.VEHICLE_COLOR)
         #print("start position is " , start_pos)
         #centre_pos = np.asarray(((start_pos[0][0] + start_pos[0][-1])/2, (start_pos[-1][0] + start_pos[-1][-1])/2), dtype=np.int32)
         #print("vehicle_centre is ", centre_pos)
-        
-        #print("image shape is ", np.shape(img))
-        grid = np.ones((img.shape[0], img.shape[1]))
-        #print('grid shape is ', grid.shape)
-        grid[img == 0] = 0
-        grid[img == 150] = 0
-
-        for i in vehicle_pixels: # for pedestrians and other small moving objects
-            grid[img == i] = 0
-        
-        grid[np.where(img == vehicle_color)]= 0.5
+
+        lut = self._occ_lut.copy()
+        # for pedestrians and other small moving objects
+        lut[pixel_freq < 500 * GRID_SCALE ** 2] = 0
+        lut[self.VEHICLE_COLOR] = self.GRID_VEHICLE
+
+        # written into a buffer reused across frames
+        if self._grid_buf is None or self._grid_buf.shape != img.shape:
+            self._grid_buf = np.empty(img.shape, dtype=np.uint8)
+        grid = cv2.LUT(img, lut, dst=self._grid_buf)
         #cv2.imshow("Grid", grid)
         return grid
     
 
     def pixel_to_world(self,a,b):
-        dx = abs(int(a)-75)
-        d = math.sqrt((int(a)-75)**2 + (int(b)-168)**2)
-        print(dx)
-        print(d)
-        alpha = math.asin(dx/d)
+        l_x, l_y = path_pixels_to_world(np.array([int(a)], dtype=np.int32),
+                                        np.array([int(b)], dtype=np.int32),
+                                        self.cw_x, self.cw_y, self._cw_yaw_rad)
 
-        gamma = math.radians(self.cw_yaw) + alpha  # vehicle angle + alpha
-        d = d/4 # in pixel per metre
+        return carla.Location(x=float(l_x[0]), y=float(l_y[0]))
+        
 
-        l_x = d * math.sin(gamma)
-        l_y = d * math.cos(gamma)
+    def _plan(self, goal, grid):
+        """
+        Runs RRT from the vehicle pixel to the goal pixel of the grid.
+        Called on the planner thread.
 
-        l = carla.Location(x= self.cw_x  + l_x, y= self.cw_y  + l_y)
+            :param goal: goal pixel [x, y]
+            :param grid: occupancy grid
+            :return: list of path pixels from goal to start, or None
+        """
+        rrt = RRT(
+            start=[START_X, START_Y],
+            goal=goal,
+            grid = grid)
 
-        return l
-        
+        return rrt.planning(animation=self._rrt_debug)
+
+    def _fill_rrt_buffer(self, origin):
+        """
+        Converts self.path to waypoints and queues them in the RRT buffer.
+
+            :param origin: (x, y, yaw in radians) of the vehicle waypoint
+            the path was planned from
+        """
+        xy = np.asarray(self.path).reshape(-1, 2).astype(np.int32)
+        l_x, l_y = path_pixels_to_world(xy[:, 0], xy[:, 1], *origin)
+        for x, y in zip(l_x, l_y):
+
+            m = carla.Location(x=float(x), y=float(y))
+            m_waypoint = self._map.get_waypoint(m)
+            self.rrt_buffer.appendleft(m_waypoint)
 
     def run_step(self, target_speed=None,rgb=None, debug=True):
         """
@@ -265,17 +386,20 @@ class LocalPlanner(object):
 
         # Buffering the waypoints
         if not self._waypoint_buffer:
-            for i in range(self._buffer_size):
-
-                if self.waypoints_queue:
-                    for i in range(4):
-                        #print(self.waypoints_queue[0])
-                        self.waypoints_queue.popleft()
-                    self._waypoint_buffer.append(
-                        self.waypoints_queue.popleft())
-                    print(self._waypoint_buffer)
-                else:
-                    break
+            # every WAYPOINT_STRIDE-th waypoint of the plan, the tail of a
+            # plan shorter than one stride ends at its last waypoint
+            stride = self.WAYPOINT_STRIDE
+            sampled = list(islice(self.waypoints_queue, stride - 1,
+                                  stride * self._buffer_size, stride))
+            consumed = stride * len(sampled)
+            if not sampled:
+                sampled = [self.waypoints_queue[-1]]
+                consumed = len(self.waypoints_queue)
+            for elem in sampled:
+                self._buffer_append(elem)
+            for _ in range(consumed):
+                self.waypoints_queue.popleft()
+            log.debug("waypoint buffer %s", self._waypoint_buffer)
         
 
         # Current vehicle waypoint
@@ -284,75 +408,92 @@ class LocalPlanner(object):
         self.cw_x = self._current_waypoint.transform.location.x
         self.cw_y = self._current_waypoint.transform.location.y
         self.cw_yaw = self._current_waypoint.transform.rotation.yaw
-        print( "x and y of current wap", self.cw_x,self.cw_y)
-        print("current yaw", self.cw_yaw)
+        self._cw_yaw_rad = math.radians(self.cw_yaw)
+        log.debug("x and y of current wap %s %s", self.cw_x, self.cw_y)
+        log.debug("current yaw %s", self.cw_yaw)
     
         # Target waypoint
-        print("waypoint buffer value", self._waypoint_buffer[0])
+        log.debug("waypoint buffer value %s", self._waypoint_buffer[0])
         self.target_waypoint, self.target_road_option = self._waypoint_buffer[0]
         #getting the cordinates of target vehicle location
         self.tw_x = self.target_waypoint.transform.location.x
         self.tw_y = self.target_waypoint.transform.location.y
         self.tw_yaw = self.target_waypoint.transform.rotation.yaw
-        print("target yaw", self.tw_yaw)
-        print( "x and y of target wap", self.tw_x,self.tw_y)
+        log.debug("target yaw %s", self.tw_yaw)
+        log.debug("x and y of target wap %s %s", self.tw_x, self.tw_y)
 
         self._dist = math.sqrt((self.cw_x - self.tw_x)**2 + (self.cw_y - self.tw_y)**2)
-        print("hypotenuse is", self._dist)
-        self._dist = self._dist * 4 # pixel per metre = 4
+        log.debug("hypotenuse is %s", self._dist)
+        self._dist = self._dist * PIXELS_PER_METRE
 
         self._alpha = self.cw_yaw - self.tw_yaw # absolute angle
-        print("alpha",self._alpha)
+        log.debug("alpha %s", self._alpha)
 
         self._a =  self._dist * math.sin(self._alpha)  # finding the height and width according 
         self._b =  self._dist * math.cos(self._alpha)
-        print(" a and b are", self._a,self._b)
+        log.debug("a and b are %s %s", self._a, self._b)
 
         self.oc_grid = self.occupancy_grid(rgb)
-        
+        # coarse fingerprint of the grid, to detect quasi-static frames
+        grid_key = hash(cv2.resize(self.oc_grid, (21, 21),
+                                   interpolation=cv2.INTER_AREA).tobytes())
 
-        self.start_pos = cv2.circle(self.oc_grid, (75,168), 3, (0,255,0), 3)
-        self.target_pos = cv2.circle(self.start_pos, (75-int(self._a),168-int(self._b)), 3, (0,0,255), 3)
-        #print(75 -int(self._a))
-        #print(168-int(self._b))
 
-        
-        cv2.imshow("grid", self.target_pos)
-        cv2.waitKey(1)
+        if debug:
+            # draw start and goal on a copy, RRT gets the grid untouched
+            vis = self.oc_grid.copy()
+            cv2.circle(vis, (START_X, START_Y), 3, 200, 3)
+            cv2.circle(vis, (START_X-int(self._a), START_Y-int(self._b)), 3, 100, 3)
+            # the caller's waitKey refreshes the window, no blocking wait here
+            cv2.imshow("grid", vis)
         # end of part 1
 
 
         #rrt_buffer
         if not self.rrt_buffer:                  
-            if self._waypoint_buffer:
+            if self._pending_plan is None and self._waypoint_buffer:
                 self.target_waypoint, self.target_road_option = self._waypoint_buffer[0]
-                self._waypoint_buffer.popleft()
-                print("goal is", 75-int(self._a), 168-int(self._b))
-                rrt = RRT(
-                    start=[75, 168],
-                    goal=[75-int(self._a), 168-int(self._b)],
-                    grid = self.oc_grid)
-
-                #print(rrt)
+                self._buffer_popleft()
+                goal = [START_X-int(self._a), START_Y-int(self._b)]
+                log.debug("goal is %s %s", goal[0], goal[1])
+                # vehicle pose the pixel path is relative to
+                origin = (self.cw_x, self.cw_y, self._cw_yaw_rad)
+
+                if (self._last_path is not None and grid_key == self._last_grid_key
+                        and abs(goal[0] - self._last_goal[0]) +
+                        abs(goal[1] - self._last_goal[1]) < 2):
+                    # same scene and goal as the last plan, reuse its path
+                    self.path = self._last_path
+                    self._fill_rrt_buffer(origin)
+                else:
+                    # the grid buffer is overwritten next frame, plan on a copy
+                    self._pending_plan = self._planner_exec.submit(
+                        self._plan, goal, self.oc_grid.copy())
+                    self._pending_args = (grid_key, goal, origin)
+                    if self.local_target is None:
+                        # nothing to follow yet, wait for the first plan
+                        concurrent.futures.wait([self._pending_plan])
+
+            if self._pending_plan is not None and self._pending_plan.done():
+                self.path = self._pending_plan.result()
+                self._pending_plan = None
+                grid_key, goal, origin = self._pending_args
+                log.debug("MAIN PATH %s", self.path)
+                del self.path[-2:]
+                self.pathss = self.path
+                log.debug("excluding path %s", self.pathss)
 
+                self._last_grid_key = grid_key
+                self._last_goal = goal
+                self._last_path = self.path
 
-                self.path = rrt.planning(animation= True)
-                print("MAIN PATH",self.path)
-                self.path = self.path[:-2]
-                self.pathss = self.path
-                print("excluding path",self.pathss)
-                
-
-                for (x,y) in self.path:
-                    
-                    m = self.pixel_to_world(x,y)
-                    m_waypoint = self._map.get_waypoint(m)
-                    self.rrt_buffer.appendleft(m_waypoint)
+                self._fill_rrt_buffer(origin)
         
         if self.rrt_buffer:
             self.local_target = self.rrt_buffer.popleft()
-            print(self.local_target, "local_target")
+            log.debug("%s local_target", self.local_target)
 
+        # import matplotlib.pyplot as plt  # only when plotting, it is slow to load
         # plt.imshow(self.oc_grid, cmap='gray')
         # plt.plot([x for (x, y) in self.path], [y for (x, y) in self.path], '-r')
         # plt.plot(self.cw_x, self.cw_y, "xr")
@@ -363,30 +504,28 @@ class LocalPlanner(object):
         # plt.show()
 
         if target_speed > 50:
-            args_lat = self.args_lat_hw_dict
-            args_long = self.args_long_hw_dict
+            pid_controller = self._pid_hw
         else:
-            args_lat = self.args_lat_city_dict
-            args_long = self.args_long_city_dict
-
-        self._pid_controller = VehiclePIDController(self._vehicle,
-                                                    args_lateral=args_lat,
-                                                    args_longitudinal=args_long)
+            pid_controller = self._pid_city
+        if pid_controller is not self._pid_controller:
+            # the idle controller holds stale steering and error history
+            pid_controller.reset()
+            self._pid_controller = pid_controller
 
         control = self._pid_controller.run_step(self._target_speed, self.local_target)
 
         # Purge the queue of obsolete waypoints
         vehicle_transform = self._vehicle.get_transform()
         #print(vehicle_transform)
-        max_index = -1
-
-        for i, (waypoint, _) in enumerate(self._waypoint_buffer):
-            if distance_vehicle(
-                    waypoint, vehicle_transform) < self._min_distance:
-                max_index = i
+        vt = vehicle_transform.location
+        n = len(self._waypoint_buffer)
+        dx = self._buf_xy[:n, 0] - vt.x
+        dy = self._buf_xy[:n, 1] - vt.y
+        d2 = dx * dx + dy * dy
+        max_index = int(np.max(np.where(d2 < self._min_distance ** 2,
+                                        np.arange(n), -1), initial=-1))
         if max_index >= 0:
-            for i in range(max_index + 1):
-                self._waypoint_buffer.popleft()
+            self._buffer_popleft(max_index + 1)
 
         if debug:
             draw_waypoints(self._vehicle.get_world(),
@@ -6,7 +6,6 @@ Created on Wed May 19 11:47:04 2021
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
 
 import math
@@ -16,6 +15,7 @@ show_animation = True
 
 
 def occupancy_grid():
+    import matplotlib.pyplot as plt
     img = cv2.imread('BEV.png', 0)
     plt.figure()
     fig, ax = plt.subplots(1,2)
@@ -30,10 +30,10 @@ def occupancy_grid():
     print("vehicle_centre is ", centre_pos)
     
     print("image shape is ", np.shape(img))
-    grid = np.zeros((img.shape[0], img.shape[1]))
+    grid = np.zeros((img.shape[0], img.shape[1]), dtype=np.uint8)
     print('grid shape is ', grid.shape)
-    grid[img == 0] = 1
-    grid[np.where(img == 179)]= 0.5
+    grid[img == 0] = 255
+    grid[img == 179] = 128
     plt.figure()
     plt.imshow(grid, cmap='gray')
     
@@ -91,7 +91,7 @@ class RRT:
         self.obstacle_list = []
         for x in range (self.grid.shape[0]):
            for y in range (self.grid.shape[1]):
-               if (self.grid[x][y] == 1):
+               if (self.grid[x][y] == 255):
                    self.obstacle_list.append([x,y])
         return self.obstacle_list
 
@@ -182,6 +182,7 @@ class RRT:
         return rnd
 
     def draw_graph(self, rnd=None):
+        import matplotlib.pyplot as plt
         plt.clf()
         # for stopping simulation with the esc key.
         plt.gcf().canvas.mpl_connect(
@@ -237,6 +238,7 @@ class RRT:
 
 
 def main(sx, sy, gx, gy, obstacleList, grid):
+    import matplotlib.pyplot as plt
     print("start " + __file__)
     # ====Search Path with RRT====
     #obstacleList = [(5, 5, 1), (3, 6, 2), (3, 8, 2), (3, 10, 2), (7, 5, 2),